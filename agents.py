@@ -1,61 +1,353 @@
 # agents.py
+import asyncio
+import hashlib
+import os
 import re
 import time
-from util import call_llm, build_meta_instruction
+from typing import Callable, Dict, Optional
+from util import (
+    call_llm,
+    build_meta_instruction,
+    META_PREFIX,
+    SINGLE_SHOT_META_PREFIX,
+    PROMPT_SENTINEL,
+    OUTPUT_SENTINEL,
+    END_SENTINEL,
+    STREAM_RESET,
+)
+
+# Single-shot mode asks for the optimized prompt AND its result in one LLM call.
+# Set APO_SINGLE_SHOT=0 to default to the isolated two-call pipeline.
+SINGLE_SHOT_MODE = os.environ.get("APO_SINGLE_SHOT", "1") != "0"
+SINGLE_SHOT_MAX_TOKENS = 1200
+
+# Workflows currently running, keyed on a hash of the task and mode flags, so
+# identical concurrent requests share one set of LLM calls.
+_INFLIGHT: Dict[str, asyncio.Future] = {}
 
 # NOTE: You MUST have the two functions below defined in this file (agents.py) 
 # or imported from another file:
-# async def generate_optimized_prompt(abstract_task: str, target_code: str) -> str:
-# async def execute_optimized_prompt(optimized_prompt: str, target_code: str) -> str:
+# async def generate_optimized_prompt(abstract_task: str, target_code: str, refresh: bool = False) -> str:
+# async def execute_optimized_prompt(optimized_prompt: str, target_code: str,
+#                                    on_token: Optional[Callable[[str], None]] = None,
+#                                    refresh: bool = False) -> str:
 
 # Placeholder functions assumed to exist:
-async def generate_optimized_prompt(abstract_task: str, target_code: str) -> str:
+async def generate_optimized_prompt(abstract_task: str, target_code: str, refresh: bool = False) -> str:
     meta_prompt = build_meta_instruction(abstract_task, target_code)
-    # The first LLM call for optimization
-    return await call_llm(meta_prompt, is_meta_prompt=True) 
+    # The first LLM call for optimization (cached on the task, not the long template)
+    return await call_llm(
+        meta_prompt,
+        is_meta_prompt=True,
+        system_prompt=META_PREFIX,
+        cache_key=abstract_task,
+        cache_refresh=refresh,
+    )
+
+async def execute_optimized_prompt(
+    optimized_prompt: str,
+    target_code: str,
+    on_token: Optional[Callable[[str], None]] = None,
+    refresh: bool = False,
+) -> str:
+    # The second LLM call for execution (cached on the task: optimized prompts share
+    # the same template bullets, so their embeddings are too similar to key on)
+    return await call_llm(
+        optimized_prompt,
+        is_meta_prompt=False,
+        on_token=on_token,
+        cache_key=target_code,
+        cache_refresh=refresh,
+    )
+
+async def speculative_execute(abstract_task: str, refresh: bool = False) -> str:
+    # Draft execution of the raw task; cached apart from optimized executions
+    return await call_llm(
+        abstract_task,
+        is_meta_prompt=False,
+        cache_key=abstract_task,
+        cache_namespace="draft",
+        cache_refresh=refresh,
+    )
+
+def _parse_single_shot(response: str) -> Optional[tuple[str, str]]:
+    """
+    Splits a sentinel-delimited single-shot response into (optimized_prompt, output),
+    or returns None if it is not well-formed.
+    """
+    _, found_prompt, rest = response.partition(PROMPT_SENTINEL)
+    optimized_prompt, found_output, rest = rest.partition(OUTPUT_SENTINEL)
+    optimized_output, _, _ = rest.partition(END_SENTINEL)
+    if not (found_prompt and found_output) or not optimized_prompt.strip() or not optimized_output.strip():
+        return None
+    return optimized_prompt.strip(), optimized_output.strip()
 
-async def execute_optimized_prompt(optimized_prompt: str, target_code: str) -> str:
-    # The second LLM call for execution
-    return await call_llm(optimized_prompt, is_meta_prompt=False)
+def _stream_output_section(on_token: Callable[[str], None]) -> Callable[[str], None]:
+    """
+    Wraps `on_token` so only the answer part of a single-shot response (after
+    OUTPUT_SENTINEL) is forwarded; chunks are held back until the sentinel arrives.
+    """
+    pending = ""
+    passing = False
 
+    def forward(chunk: str) -> None:
+        nonlocal pending, passing
+        if chunk == STREAM_RESET:
+            pending, passing = "", False
+            on_token(chunk)
+        elif passing:
+            on_token(chunk)
+        else:
+            pending += chunk
+            _, found, answer = pending.partition(OUTPUT_SENTINEL)
+            if found:
+                pending, passing = "", True
+                answer = answer.partition(END_SENTINEL)[0].lstrip("\n")
+                if answer:
+                    on_token(answer)
 
-async def apo_workflow(abstract_task: str) -> dict:
+    return forward
+
+async def generate_and_execute_prompt(
+    abstract_task: str,
+    target_code: str,
+    on_token: Optional[Callable[[str], None]] = None,
+    refresh: bool = False,
+) -> Optional[tuple[str, str]]:
+    """
+    Single LLM call that returns (optimized_prompt, output) parsed from the
+    sentinel-delimited response, or None if the response is not well-formed.
+    `on_token` receives the answer section as it streams in.
+    """
+    meta_prompt = build_meta_instruction(abstract_task, target_code)
+    # The response carries the user-facing output, so it goes to the execution model
+    response = await call_llm(
+        meta_prompt,
+        is_meta_prompt=False,
+        max_tokens=SINGLE_SHOT_MAX_TOKENS,
+        cache_key=abstract_task,
+        cache_namespace="single_shot",
+        # Never persist a malformed response, or every rerun would replay it
+        cache_validate=lambda text: _parse_single_shot(text) is not None,
+        cache_refresh=refresh,
+        on_token=_stream_output_section(on_token) if on_token is not None else None,
+        system_prompt=SINGLE_SHOT_META_PREFIX,
+    )
+    if response.startswith("Error:"):
+        raise ConnectionError(response)
+    return _parse_single_shot(response)
+
+
+# --- Output Parsing ---
+# Plain linear string scans rather than regexes, so a pathological LLM response
+# (e.g. an unclosed code fence) can never backtrack and stall the event loop.
+
+def _split_role(prompt: str) -> tuple[str, str]:
+    """
+    Returns (role, prompt without its ROLE line); the role is "N/A" when absent.
+    """
+    lines = prompt.splitlines()
+    for index, line in enumerate(lines):
+        stripped = line.lstrip()
+        if stripped.startswith("ROLE") and stripped[4:5] in (":", " ", ""):
+            role = stripped[4:].lstrip(":").strip()
+            remaining = lines[:index] + lines[index + 1:]
+            return role or "N/A", "\n".join(remaining).strip()
+    return "N/A", prompt.strip()
+
+
+def _extract_code_block(text: str) -> Optional[str]:
+    """
+    Returns the body of the first fenced code block (after its language line), or None.
+    """
+    start = text.find("```")
+    if start == -1:
+        return None
+    newline = text.find("\n", start + 3)
+    if newline == -1:
+        return None
+    end = text.find("```", newline + 1)
+    if end == -1:
+        return None
+    return text[newline + 1:end]
+
+
+# --- Speculative Execution ---
+
+_WORD_RE = re.compile(r"[a-z]{4,}")
+_CONSTRAINT_PREFIXES = ("-", "*", "•")
+
+# Minimum share of constraint keywords a speculative draft must mention to be kept.
+SPECULATIVE_MIN_OVERLAP = 0.5
+
+
+def _draft_satisfies(draft: str, optimized_prompt: str) -> bool:
+    """
+    Cheap check that a speculative draft already honours the optimized prompt:
+    code must be fenced when code is demanded, and the draft must share enough
+    keywords with the prompt's bullet-point constraints.
+    """
+    if draft.startswith("Error:"):
+        return False
+
+    prompt_lower = optimized_prompt.lower()
+    if ("code" in prompt_lower or "function" in prompt_lower) and "```" not in draft:
+        return False
+
+    constraint_lines = [
+        line for line in prompt_lower.splitlines()
+        if line.strip().startswith(_CONSTRAINT_PREFIXES) or line.strip()[:1].isdigit()
+    ]
+    constraint_words = set(_WORD_RE.findall(" ".join(constraint_lines)))
+    if not constraint_words:
+        return True
+
+    draft_words = set(_WORD_RE.findall(draft.lower()))
+    overlap = len(constraint_words & draft_words) / len(constraint_words)
+    return overlap >= SPECULATIVE_MIN_OVERLAP
+
+
+async def _optimize_and_execute(
+    abstract_task: str,
+    speculative: bool,
+    single_shot: bool,
+    on_token: Optional[Callable[[str], None]] = None,
+    refresh: bool = False,
+) -> tuple[str, str]:
+    """
+    Runs the optimizer and the execution call. With `single_shot` enabled both
+    come from one LLM call, falling back to the two-call path on a malformed
+    response. With `speculative` enabled a draft execution of the raw task is
+    issued concurrently with the optimizer; it is kept only if it finished
+    first and satisfies the optimized prompt, and cancelled otherwise.
+    Only the user-facing output call streams to `on_token`. With `refresh` enabled
+    every call bypasses the semantic cache and overwrites its entry.
+    """
+    if single_shot:
+        result = await generate_and_execute_prompt(abstract_task, abstract_task, on_token, refresh)
+        if result is not None:
+            return result
+        print("Single-shot response was malformed. Falling back to two-call workflow...")
+        if on_token is not None:
+            # Drop any partial single-shot answer before the fallback streams its own
+            on_token(STREAM_RESET)
+
+    if not speculative:
+        optimized_prompt = await generate_optimized_prompt(abstract_task, abstract_task, refresh)
+        if optimized_prompt.startswith("Error:"):
+            raise ConnectionError(optimized_prompt)
+        return optimized_prompt, await execute_optimized_prompt(
+            optimized_prompt, abstract_task, on_token, refresh
+        )
+
+    optimizer = asyncio.create_task(generate_optimized_prompt(abstract_task, abstract_task, refresh))
+    draft = asyncio.create_task(speculative_execute(abstract_task, refresh))
+    try:
+        done, _ = await asyncio.wait({optimizer, draft}, return_when=asyncio.FIRST_COMPLETED)
+        optimized_prompt = await optimizer
+
+        if optimized_prompt.startswith("Error:"):
+            raise ConnectionError(optimized_prompt)
+
+        # The draft only wins if it beat the optimizer and meets its constraints
+        if draft in done and _draft_satisfies(draft.result(), optimized_prompt):
+            if on_token is not None:
+                on_token(draft.result())
+            return optimized_prompt, draft.result()
+    finally:
+        # Cancel whichever call is still running so it stops consuming tokens
+        for pending in (optimizer, draft):
+            if not pending.done():
+                pending.cancel()
+
+    return optimized_prompt, await execute_optimized_prompt(
+        optimized_prompt, abstract_task, on_token, refresh
+    )
+
+
+async def apo_workflow(
+    abstract_task: str,
+    speculative: bool = False,
+    single_shot: bool = SINGLE_SHOT_MODE,
+    on_token: Optional[Callable[[str], None]] = None,
+    refresh: bool = False,
+) -> dict:
     """
     The main workflow: generate optimized prompt -> execute it -> returns results.
+    With `single_shot` enabled both steps share one LLM call; pass False for tasks
+    that need the prompt to be executed in isolation. With `speculative` enabled,
+    the two-call path produces a draft answer while the prompt is being optimized
+    and reuses it when it already meets the optimized prompt; it is off by
+    default, since the small meta model nearly always beats the draft, which
+    is then cancelled after being billed. `on_token`, if
+    given, receives the output text incrementally as it is generated. With
+    `refresh` enabled the semantic cache is bypassed and its entries overwritten.
+
+    If the same task is already running in the same mode, this awaits that run's
+    result instead of issuing new LLM calls (its output is then not streamed to
+    `on_token`).
+    """
+    # Mode flags are part of the key: a caller asking for isolation must not get a single-shot result
+    key = hashlib.blake2s(f"{speculative}:{single_shot}:{refresh}:{abstract_task}".encode()).hexdigest()
+    inflight = _INFLIGHT.get(key)
+    if inflight is not None:
+        # shield: a cancelled waiter must not cancel the shared run
+        return dict(await asyncio.shield(inflight))
+
+    future = asyncio.get_running_loop().create_future()
+    _INFLIGHT[key] = future
+    try:
+        result = await _run_workflow(abstract_task, speculative, single_shot, on_token, refresh)
+    except BaseException as e:
+        if isinstance(e, asyncio.CancelledError):
+            future.cancel()
+        else:
+            future.set_exception(e)
+            # Mark the exception retrieved so it is not logged when nobody else awaited it
+            future.exception()
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        del _INFLIGHT[key]
+
+
+async def _run_workflow(
+    abstract_task: str,
+    speculative: bool,
+    single_shot: bool,
+    on_token: Optional[Callable[[str], None]],
+    refresh: bool,
+) -> dict:
+    """
+    Runs one uncoalesced workflow; see apo_workflow.
     """
     start_time = time.time()
     
-    # 1. Generate Optimized Prompt
-    optimized_prompt = await generate_optimized_prompt(abstract_task, abstract_task)
-    
-    # 2. Check for LLM connection failure (Step 1)
-    if optimized_prompt.startswith("Error:"):
-        # Raise a fatal error for Streamlit to catch if LLM connection failed
-        raise ConnectionError(optimized_prompt) 
-    
-    # 3. Parse and Clean Prompt for display
-    role_match = re.search(r"ROLE:? ?([A-Za-z0-9 ,\-]*)", optimized_prompt)
-    chosen_role = role_match.group(1).strip() if role_match else "N/A"
-    cleaned_prompt = re.sub(r"ROLE:? ?[A-Za-z0-9 ,\-]*\n?", "", optimized_prompt).strip()
+    # 1. Generate Optimized Prompt (raises ConnectionError on LLM failure) and execute it
+    optimized_prompt, optimized_output = await _optimize_and_execute(
+        abstract_task, speculative, single_shot, on_token, refresh
+    )
     
-    # 4. Execute Optimized Prompt
-    optimized_output = await execute_optimized_prompt(optimized_prompt, abstract_task)
+    # 2. Parse and Clean Prompt for display
+    chosen_role, cleaned_prompt = _split_role(optimized_prompt)
 
-    # 5. Check for LLM connection failure (Step 2)
+    # 3. Check for LLM connection failure (execution call)
     if optimized_output.startswith("Error:"):
         raise ConnectionError(optimized_output)
     
-    # 6. Extract Final Output
-    code_match = re.search(r"```(.*?)\n(.*?)```", optimized_output, re.DOTALL)
+    # 4. Extract Final Output
+    code_block = _extract_code_block(optimized_output)
     
-    if code_match:
-        final_output = code_match.group(2).strip()
+    if code_block is not None:
+        final_output = code_block.strip()
         output_type = "code"
     else:
         final_output = optimized_output.strip()
         output_type = "text"
         
-    # 7. Calculate Metrics and Return
+    # 5. Calculate Metrics and Return
     pect = round(time.time() - start_time, 2)
     
     return {
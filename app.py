@@ -1,8 +1,12 @@
 # app.py
 import streamlit as st
 import asyncio
-from agents import apo_workflow # CORRECTED IMPORT: from agents (plural)
-from util import HIGH_SPEED_MODE 
+import queue
+import re
+import threading
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from agents import apo_workflow, SINGLE_SHOT_MODE # CORRECTED IMPORT: from agents (plural)
+from util import HIGH_SPEED_MODE, STREAM_RESET 
 
 # --- Streamlit App Configuration ---
 st.set_page_config(
@@ -11,17 +15,107 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# ----------------------------------------------------
+# PERSISTENT EVENT LOOP FOR ALL WORKFLOW RUNS
+# ----------------------------------------------------
+@st.cache_resource
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Starts a single event loop in a daemon thread for the lifetime of the
+    Streamlit process, so reruns reuse it (and its open connections)
+    instead of building a fresh loop per call.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+LOOP = get_event_loop()
+
+
 # ----------------------------------------------------
 # FINAL CRITICAL FIX: CACHED FUNCTION TO ISOLATE ASYNC CALL
 # ----------------------------------------------------
+@st.cache_data(ttl=3600, max_entries=128, show_spinner=False)
+def get_workflow_results(task: str, _on_token=None, _refresh=False):
+    """
+    Submits the asynchronous apo_workflow to the persistent event loop,
+    blocks until it finishes, and caches the result per task (for an hour).
+    `_on_token` and `_refresh` are left out of the cache key; `_on_token`
+    receives streamed output chunks on a cache miss, and `_refresh` makes
+    that miss bypass the semantic LLM cache as well.
+    """
+    workflow = apo_workflow(task, on_token=_on_token, refresh=_refresh)
+    return asyncio.run_coroutine_threadsafe(workflow, LOOP).result()
+
+
+def run_workflow_streaming(task: str, placeholder, refresh: bool = False) -> dict:
+    """
+    Runs get_workflow_results on a worker thread and renders the streamed
+    output into `placeholder` from the script thread as chunks arrive.
+    With `refresh` enabled the task's cached result is dropped and recomputed.
+    """
+    chunks = queue.SimpleQueue()
+    outcome = {}
+
+    def worker():
+        try:
+            outcome["results"] = get_workflow_results(task, chunks.put, refresh)
+        except Exception as e:
+            outcome["error"] = e
+
+    if refresh:
+        # Drop only this task's entry; other tasks keep their cached results
+        get_workflow_results.clear(task)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    add_script_run_ctx(thread, get_script_run_ctx())
+    thread.start()
+
+    buffer = ""
+    while thread.is_alive() or not chunks.empty():
+        try:
+            chunk = chunks.get(timeout=0.05)
+        except queue.Empty:
+            continue
+        # A retry or fallback restarts the answer, so drop what was shown so far
+        buffer = "" if chunk == STREAM_RESET else buffer + chunk
+        placeholder.markdown(buffer)
+    placeholder.empty()
+
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["results"]
+
+
+def _fenced(text: str, language: str) -> str:
+    """
+    Wraps text in a markdown code fence longer than any backtick run inside it.
+    """
+    longest_run = max((len(run) for run in re.findall(r"`+", text)), default=0)
+    fence = "`" * max(3, longest_run + 1)
+    return f"{fence}{language}\n{text}\n{fence}"
+
+
 @st.cache_data(show_spinner=False)
-def get_workflow_results(task: str):
+def render_results_markdown(results: dict) -> str:
     """
-    Safely runs the asynchronous apo_workflow using asyncio.run() 
-    to prevent event loop conflicts and caches the result.
+    Formats the prompt and output sections as one markdown string, so the
+    results panel is a single element and identical results skip formatting.
     """
-    # The async function is run safely within the cached thread
-    return asyncio.run(apo_workflow(task))
+    if results['output_type'] == 'code':
+        final_output = _fenced(results['final_output'], "python")
+    else:
+        final_output = results['final_output']
+
+    return (
+        "---\n\n"
+        "### 1. Optimized Prompt (The 'Pitch' Value)\n\n"
+        f"{_fenced(results['optimized_prompt'], 'markdown')}\n\n"
+        "This clean, precise prompt is what guarantees the high-quality final output.\n\n"
+        "### 2. Final AI Output\n\n"
+        f"{final_output}"
+    )
 
 
 # --- Display Configuration ---
@@ -30,16 +124,34 @@ if HIGH_SPEED_MODE:
 else:
     st.sidebar.warning("Slow Mode (Ollama) is Active. Set GROQ_API_KEY for speed.")
 
-st.sidebar.markdown(
-    """
-    ## 🛠️ Workflow Steps
-    1. User submits vague **Abstract Task**.
-    2. **Optimization Agent** (LLM-1) generates a precise **Optimized Prompt**.
-    3. **Execution Agent** (LLM-2) executes the optimized prompt.
-    4. **Final Output** (Code/Text) is displayed.
-    """
+force_refresh = st.sidebar.checkbox(
+    "Force refresh",
+    value=False,
+    help="Ignore cached results for this task and run the workflow again, replacing them.",
 )
 
+# Describe the pipeline that actually runs (APO_SINGLE_SHOT=0 selects the two-call one)
+if SINGLE_SHOT_MODE:
+    st.sidebar.markdown(
+        """
+        ## 🛠️ Workflow Steps
+        1. User submits vague **Abstract Task**.
+        2. **Optimization Agent** (one LLM call) writes a precise **Optimized Prompt** and answers it.
+        3. If that response is malformed, the prompt is regenerated and executed in two separate calls.
+        4. **Final Output** (Code/Text) is displayed.
+        """
+    )
+else:
+    st.sidebar.markdown(
+        """
+        ## 🛠️ Workflow Steps
+        1. User submits vague **Abstract Task**.
+        2. **Optimization Agent** (LLM-1) generates a precise **Optimized Prompt**.
+        3. **Execution Agent** (LLM-2) executes the optimized prompt.
+        4. **Final Output** (Code/Text) is displayed.
+        """
+    )
+
 st.title("💡 Universal Optimization Agent")
 st.caption("Demonstrating the power of Meta-Prompting for guaranteed quality AI output.")
 
@@ -56,48 +168,40 @@ if st.button("Run Optimization Workflow", type="primary"):
         st.error("Please enter a task description.")
     else:
         # Use st.spinner to show progress while the async task runs
-        with st.spinner('Running the full two-stage agent workflow...'):
+        spinner_text = (
+            'Optimizing and executing the prompt in a single call...'
+            if SINGLE_SHOT_MODE
+            else 'Running the full two-stage agent workflow...'
+        )
+        with st.spinner(spinner_text):
             try:
-                # Clear cache to force a new run
-                get_workflow_results.clear()
-                
-                # Call the cached function which safely executes the async logic
-                results = get_workflow_results(abstract_task.strip())
-                
-                # --- Display Results ---
-                st.subheader("Results")
+                # Call the cached function which safely executes the async logic,
+                # streaming the output into a live preview on a cache miss.
+                # Repeated tasks are served from the cache unless a refresh is forced.
+                results = run_workflow_streaming(abstract_task.strip(), st.empty(), force_refresh)
                 
-                col1, col2 = st.columns(2)
-                
-                with col1:
-                    st.metric(
-                        label="Optimization Cycle Time (PECT)", 
-                        value=f"{results['execution_time_seconds']:.2f} s"
-                    )
-                    st.info(f"**Role Selected:** {results['role_selected']}")
-
-                with col2:
-                    st.metric(
-                        label="Output Type", 
-                        value=results['output_type'].upper()
-                    )
-                    st.info(f"**Original Task:** {results['user_task'][:50]}...")
-                
-                st.markdown("---")
-
-                # Optimized Prompt Section
-                st.subheader("1. Optimized Prompt (The 'Pitch' Value)")
-                st.code(results['optimized_prompt'], language="markdown")
-                st.markdown(
-                    "This clean, precise prompt is what guarantees the high-quality final output."
-                )
-
-                # Final Output Section
-                st.subheader("2. Final AI Output")
-                if results['output_type'] == 'code':
-                    st.code(results['final_output'], language="python")
-                else:
-                    st.markdown(results['final_output'])
+                # --- Display Results (one container, one markdown body) ---
+                with st.container():
+                    st.subheader("Results")
+                    
+                    col1, col2 = st.columns(2, gap="small")
+                    
+                    with col1:
+                        st.metric(
+                            label="Optimization Cycle Time (PECT)", 
+                            value=f"{results['execution_time_seconds']:.2f} s"
+                        )
+                        st.info(f"**Role Selected:** {results['role_selected']}")
+
+                    with col2:
+                        st.metric(
+                            label="Output Type", 
+                            value=results['output_type'].upper()
+                        )
+                        st.info(f"**Original Task:** {results['user_task'][:50]}...")
+
+                    # Optimized Prompt and Final Output sections
+                    st.markdown(render_results_markdown(results))
 
             except Exception as e:
                 # This catch handles the ConnectionError raised from agents.py 
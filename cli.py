@@ -1,29 +1,94 @@
 # cli.py
+import argparse
 import asyncio
+import json
 import sys
 from agents import apo_workflow
 
+# Lines consisting only of this separator split stdin into a batch of tasks
+TASK_SEPARATOR = "---"
+# Default number of workflows in flight at once in batch mode (Groq rate limits)
+DEFAULT_CONCURRENCY = 8
+
+
+def split_tasks(text: str) -> list[str]:
+    """
+    Splits the input on '---' lines into individual, non-empty tasks.
+    """
+    tasks, current = [], []
+    for line in text.splitlines():
+        if line.strip() == TASK_SEPARATOR:
+            tasks.append("\n".join(current).strip())
+            current = []
+        else:
+            current.append(line)
+    tasks.append("\n".join(current).strip())
+    return [task for task in tasks if task]
+
+
+async def run_batch(tasks: list[str], concurrency: int) -> list:
+    """
+    Runs apo_workflow for all tasks on one event loop, with at most `concurrency`
+    in flight. A failed task yields its exception instead of aborting the batch.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def guarded(task: str) -> dict:
+        async with semaphore:
+            return await apo_workflow(task)
+
+    return await asyncio.gather(*(guarded(task) for task in tasks), return_exceptions=True)
+
+
+def print_batch_results(tasks: list[str], results: list) -> None:
+    """
+    Prints each task's result (or error) in input order.
+    """
+    for index, (task, result) in enumerate(zip(tasks, results), start=1):
+        print(f"\n--- Task {index}/{len(tasks)}: {task[:50]} ---")
+        if isinstance(result, Exception):
+            print(f"Error: {result}")
+        else:
+            print(json.dumps(result, indent=2, ensure_ascii=False))
+
+
 def main():
     """
     Handles command-line input and runs the asynchronous workflow.
+    Multiple tasks separated by '---' lines are processed concurrently.
     """
+    parser = argparse.ArgumentParser(description="Run the APO workflow on tasks read from stdin.")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"Maximum workflows in flight in batch mode (default: {DEFAULT_CONCURRENCY}).",
+    )
+    args = parser.parse_args()
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+
     print("Enter any vague or general request (finish with Ctrl+D [Linux/Mac] or Ctrl+Z then Enter [Windows]):")
+    print(f"To run a batch, separate tasks with a line containing only '{TASK_SEPARATOR}'.")
     
     # Read multiline input from standard input until EOF
-    lines = sys.stdin.readlines()
-    abstract_task = ''.join(lines).strip()
+    tasks = split_tasks(sys.stdin.read())
 
-    if not abstract_task:
+    if not tasks:
         print("No task entered. Exiting.")
         return
 
     # Run the main asynchronous workflow
     try:
-        asyncio.run(apo_workflow(abstract_task))
+        if len(tasks) > 1:
+            results = asyncio.run(run_batch(tasks, args.concurrency))
+            print_batch_results(tasks, results)
+        else:
+            asyncio.run(apo_workflow(tasks[0]))
     except ImportError as e:
         print(f"\n--- Dependency Error ---")
         print(f"Failed to run due to missing dependency: {e}")
-        print("Please ensure 'groq' and 'ollama' libraries are installed if you intend to use them.")
+        print("Please install the packages listed in requirements.txt (e.g. 'httpx', 'streamlit').")
     except Exception as e:
         print(f"\n--- An unexpected error occurred ---")
         print(e)
@@ -0,0 +1,198 @@
+# semantic_cache.py
+import asyncio
+import functools
+import inspect
+import os
+import sqlite3
+import threading
+import streamlit as st
+from typing import Awaitable, Callable, Dict, List, Optional
+
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # The cache is optional; call_llm works without it
+    np = None
+    SentenceTransformer = None
+
+
+# --- Cache Configuration ---
+
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+CACHE_PATH = os.environ.get("APO_CACHE_PATH", ".apo_semantic_cache.sqlite3")
+CACHE_ENABLED = os.environ.get("APO_SEMANTIC_CACHE", "1") != "0"
+
+# Cosine similarity at or above which a stored completion is reused
+SIMILARITY_THRESHOLD = 0.95
+
+
+class UncacheableResponse(str):
+    """
+    A completion that is returned to the caller but never stored (e.g. one cut off at max_tokens).
+    """
+
+
+@st.cache_resource(show_spinner=False)
+def get_embedder() -> "SentenceTransformer":
+    """
+    Loads the embedding model once per process (~2s) and shares it across sessions.
+    """
+    return SentenceTransformer(EMBEDDING_MODEL)
+
+
+class SemanticCache:
+    """
+    Stores LLM completions next to the embedding of the text that produced them.
+    Embeddings are kept in memory per namespace for brute-force cosine search and
+    mirrored to SQLite so the cache survives process restarts.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, threshold: float = SIMILARITY_THRESHOLD):
+        self.threshold = threshold
+        self._model = get_embedder()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "id INTEGER PRIMARY KEY, namespace TEXT, embedding BLOB, content TEXT)"
+        )
+        self._conn.commit()
+
+        self._ids: Dict[str, List[int]] = {}
+        self._embeddings: Dict[str, List["np.ndarray"]] = {}
+        self._contents: Dict[str, List[str]] = {}
+        for row_id, namespace, blob, content in self._conn.execute(
+            "SELECT id, namespace, embedding, content FROM llm_cache ORDER BY id"
+        ):
+            self._ids.setdefault(namespace, []).append(row_id)
+            self._embeddings.setdefault(namespace, []).append(np.frombuffer(blob, dtype=np.float32))
+            self._contents.setdefault(namespace, []).append(content)
+
+    def embed(self, text: str) -> "np.ndarray":
+        """
+        Returns the L2-normalised embedding of `text`, so a dot product is the cosine.
+        """
+        return self._model.encode(text, normalize_embeddings=True).astype(np.float32)
+
+    def lookup(self, embedding: "np.ndarray", namespace: str) -> Optional[str]:
+        """
+        Returns the cached completion of the nearest neighbour, or None below threshold.
+        """
+        with self._lock:
+            vectors = self._embeddings.get(namespace)
+            if not vectors:
+                return None
+            similarities = np.stack(vectors) @ embedding
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                return self._contents[namespace][best]
+        return None
+
+    def add(self, embedding: "np.ndarray", namespace: str, content: str) -> None:
+        """
+        Stores `content`, replacing any entry a lookup of `embedding` would have returned.
+        """
+        with self._lock:
+            ids = self._ids.setdefault(namespace, [])
+            vectors = self._embeddings.setdefault(namespace, [])
+            contents = self._contents.setdefault(namespace, [])
+            if vectors:
+                stale = np.flatnonzero(np.stack(vectors) @ embedding >= self.threshold)
+                self._conn.executemany(
+                    "DELETE FROM llm_cache WHERE id = ?", [(ids[i],) for i in stale]
+                )
+                for i in reversed(stale.tolist()):
+                    del ids[i], vectors[i], contents[i]
+
+            cursor = self._conn.execute(
+                "INSERT INTO llm_cache (namespace, embedding, content) VALUES (?, ?, ?)",
+                (namespace, embedding.tobytes(), content),
+            )
+            self._conn.commit()
+            ids.append(cursor.lastrowid)
+            vectors.append(embedding)
+            contents.append(content)
+
+
+@st.cache_resource(show_spinner=False)
+def get_semantic_cache() -> Optional[SemanticCache]:
+    """
+    Lazily builds the process-wide cache (and its SQLite connection) once, shared
+    across sessions. Returns None when disabled, when sentence-transformers is
+    not installed, or when the cache cannot be built (e.g. the embedding model
+    cannot be downloaded offline); the None is cached so this is tried once.
+    """
+    if not CACHE_ENABLED:
+        return None
+    if SentenceTransformer is None:
+        print("Semantic cache disabled: install 'sentence-transformers' to enable it.")
+        return None
+    try:
+        return SemanticCache()
+    except Exception as e:
+        print(f"Semantic cache disabled: failed to initialise ({e}).")
+        return None
+
+
+def semantic_cache(func: Callable[..., Awaitable[str]]) -> Callable[..., Awaitable[str]]:
+    """
+    Decorator for call_llm: returns a stored completion when a semantically
+    equivalent prompt was answered before. Meta and execution prompts are cached
+    in separate namespaces unless `cache_namespace` names another one.
+    `cache_key` overrides the text that is embedded (e.g. the bare task instead
+    of a long templated prompt, whose shared boilerplate would dominate the
+    embedding). Error strings are never cached, nor is anything `cache_validate`
+    rejects (e.g. a response in the wrong format). `cache_refresh` skips the
+    lookup and overwrites the stored entry. All four are keyword-only.
+    The cache is only a speed-up: a failed lookup counts as a miss and a failed
+    store is logged and ignored, so call_llm still always returns a string.
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    async def wrapper(
+        prompt_to_send: str,
+        is_meta_prompt: bool = True,
+        *args,
+        cache_key: Optional[str] = None,
+        cache_namespace: Optional[str] = None,
+        cache_validate: Optional[Callable[[str], bool]] = None,
+        cache_refresh: bool = False,
+        **kwargs,
+    ) -> str:
+        cached = None
+        try:
+            # The first call loads the embedding model; do it off the event loop
+            cache = await asyncio.to_thread(get_semantic_cache)
+            if cache is not None:
+                namespace = cache_namespace or ("meta" if is_meta_prompt else "execution")
+                # Embedding and nearest-neighbour search are CPU-bound; keep them off the event loop
+                embedding = await asyncio.to_thread(cache.embed, cache_key or prompt_to_send)
+                if not cache_refresh:
+                    cached = await asyncio.to_thread(cache.lookup, embedding, namespace)
+        except Exception as e:
+            print(f"Semantic cache lookup failed, calling the LLM instead: {e}")
+            cache = None
+
+        if cache is None:
+            return await func(prompt_to_send, is_meta_prompt, *args, **kwargs)
+        if cached is not None:
+            on_token = signature.bind(prompt_to_send, is_meta_prompt, *args, **kwargs).arguments.get("on_token")
+            if on_token is not None:
+                on_token(cached)
+            return cached
+
+        content = await func(prompt_to_send, is_meta_prompt, *args, **kwargs)
+        if (
+            not content.startswith("Error:")
+            and not isinstance(content, UncacheableResponse)
+            and (cache_validate is None or cache_validate(content))
+        ):
+            try:
+                await asyncio.to_thread(cache.add, embedding, namespace, content)
+            except Exception as e:
+                # e.g. "database is locked" while the CLI and the app share the file
+                print(f"Semantic cache store failed, skipping: {e}")
+        return content
+
+    return wrapper
@@ -1,25 +1,42 @@
 import asyncio
+import math
 import os
+import random
+import time
+from contextlib import aclosing
 import re
 import streamlit as st
-import requests # Added requests for reliable Groq/Ollama API calls
-import json
+import httpx # Native async HTTP client with keep-alive pooling for Groq/Ollama calls
+import orjson # Faster JSON (de)serialization for request and response bodies
 from typing import Optional, Dict, Any, Awaitable, Callable, Tuple
+from semantic_cache import semantic_cache, UncacheableResponse
 
 
 # --- LLM Client Setup ---
 
 # Configuration
 MODEL_NAME = "llama3.1"
-GROQ_MODEL = "moonshotai/kimi-k2-instruct-0905"
+# Prompt rewriting is a bounded transformation, so it runs on a small fast model;
+# the larger model is reserved for producing the user-facing output.
+GROQ_META_MODEL = "llama-3.1-8b-instant"
+GROQ_EXEC_MODEL = "llama-3.3-70b-versatile"
 OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://localhost:11434/api/generate")
 OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "llama3")
 
-# CRITICAL FIX: Prioritize Streamlit secrets manager for deployment
-if "GROQ_API_KEY" in st.secrets:
-    GROQ_API_KEY = st.secrets["GROQ_API_KEY"]
-else:
-    GROQ_API_KEY = os.environ.get("GROQ_API_KEY", None)
+def _load_groq_api_key() -> Optional[str]:
+    """
+    Prioritizes the Streamlit secrets manager for deployment, falling back to the
+    environment when no secrets file exists (e.g. the CLI or local runs).
+    """
+    try:
+        if "GROQ_API_KEY" in st.secrets:
+            return st.secrets["GROQ_API_KEY"]
+    except st.errors.StreamlitSecretNotFoundError:
+        pass
+    return os.environ.get("GROQ_API_KEY", None)
+
+
+GROQ_API_KEY = _load_groq_api_key()
 
 # Initialize Clients
 # HIGH_SPEED_MODE is now purely determined by the presence of the API key,
@@ -27,11 +44,159 @@ else:
 HIGH_SPEED_MODE = bool(GROQ_API_KEY)
 
 
+@st.cache_resource(show_spinner=False)
+def _get_http_client() -> httpx.AsyncClient:
+    """
+    Shared async HTTP client, built on first use so importing this module costs
+    nothing, and held by st.cache_resource so every session reuses it. The TLS
+    handshake to Groq happens once and later calls reuse the pooled keep-alive
+    (HTTP/2) connection.
+    """
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=16, max_connections=32),
+        timeout=httpx.Timeout(30.0, connect=10.0),
+    )
+
+
+# --- Retry Policy ---
+
+GROQ_MAX_RETRIES = 3
+# Per-attempt HTTP timeout, so a stalled Groq connection fails fast and is retried
+GROQ_ATTEMPT_TIMEOUT_SECONDS = 8.0
+# Slowest decode rate budgeted for while waiting on a non-streamed completion
+GROQ_MIN_TOKENS_PER_SECOND = 100
+
+
+def _attempt_timeout(max_tokens: int, streaming: bool) -> httpx.Timeout:
+    """
+    Streamed responses send bytes continuously, so the flat timeout bounds stalls.
+    A non-streamed response sends nothing until decoding finishes, so its read
+    timeout grows with max_tokens.
+    """
+    if streaming:
+        return httpx.Timeout(GROQ_ATTEMPT_TIMEOUT_SECONDS)
+    read_timeout = GROQ_ATTEMPT_TIMEOUT_SECONDS + max_tokens / GROQ_MIN_TOKENS_PER_SECOND
+    return httpx.Timeout(GROQ_ATTEMPT_TIMEOUT_SECONDS, read=read_timeout)
+
+
+class _LatencyBudget:
+    """
+    Online p95 estimate of Groq call latency, from an exponentially weighted
+    mean and variance. Attempts running past it are cancelled and retried.
+    """
+
+    def __init__(self, alpha: float = 0.2, floor: float = 2.0, ceiling: float = 30.0, warmup: int = 5):
+        self.alpha = alpha
+        self.floor = floor
+        self.ceiling = ceiling
+        self.warmup = warmup
+        self.mean = 0.0
+        self.var = 0.0
+        self.samples = 0
+
+    def observe(self, seconds: float) -> None:
+        if self.samples == 0:
+            self.mean = seconds
+        else:
+            diff = seconds - self.mean
+            increment = self.alpha * diff
+            self.mean += increment
+            self.var = (1 - self.alpha) * (self.var + diff * increment)
+        self.samples += 1
+
+    def seconds(self) -> Optional[float]:
+        """
+        Current budget, or None (no limit) until enough samples were observed.
+        """
+        if self.samples < self.warmup:
+            return None
+        p95 = self.mean + 1.645 * math.sqrt(self.var)
+        return min(max(p95, self.floor), self.ceiling)
+
+
+# One budget per (model, max_tokens, streaming) route, since their latencies differ
+# widely. Streamed routes measure time to first token, not the full completion.
+_LATENCY_BUDGETS: Dict[Tuple[str, int, bool], _LatencyBudget] = {}
+
+
 # --- Core LLM Call Functions ---
 
-async def _ollama_generate(prompt: str) -> str:
+# Passed to `on_token` to tell the consumer to discard everything streamed so far,
+# because a retry or fallback is about to stream the answer again from the start.
+STREAM_RESET = ""
+
+async def _groq_stream(url: str, headers: Dict[str, str], payload: Dict[str, Any]):
+    """
+    Async generator over Groq's server-sent event stream, yielding (content delta,
+    finish_reason) pairs as they arrive; either may be None.
+    """
+    async with _get_http_client().stream(
+        "POST",
+        url,
+        headers=headers,
+        content=orjson.dumps(payload),
+        timeout=_attempt_timeout(payload["max_tokens"], streaming=True),
+    ) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            data = line[len("data: "):]
+            if data == "[DONE]":
+                break
+            choice = orjson.loads(data)["choices"][0]
+            yield choice.get("delta", {}).get("content"), choice.get("finish_reason")
+
+
+async def _groq_attempt(
+    url: str,
+    headers: Dict[str, str],
+    payload: Dict[str, Any],
+    on_token: Optional[Callable[[str], None]],
+    first_token_timeout: Optional[float] = None,
+) -> Tuple[Optional[str], bool]:
+    """
+    A single Groq request, streamed to `on_token` when given. Returns the content
+    (or None) and whether generation stopped because it hit max_tokens. When
+    streaming, TimeoutError is raised if no token arrives within `first_token_timeout`;
+    once tokens flow the attempt is never cut short (that would restart the stream).
+    """
+    if on_token is None:
+        # Reuses a pooled connection; no thread hop needed
+        response = await _get_http_client().post(
+            url,
+            headers=headers,
+            content=orjson.dumps(payload),
+            timeout=_attempt_timeout(payload["max_tokens"], streaming=False),
+        )
+        response.raise_for_status() # Raises HTTPError for bad responses (4xx or 5xx)
+        
+        data = orjson.loads(response.content)
+        # CRITICAL FIX: Direct access to content and validation
+        choice = data.get('choices', [{}])[0]
+        return choice.get('message', {}).get('content'), choice.get('finish_reason') == "length"
+
+    # Surface tokens as they are decoded instead of waiting for the full completion
+    chunks = []
+    finish_reason = None
+    # aclosing: a timed-out stream releases its connection right away
+    async with asyncio.timeout(first_token_timeout) as deadline, aclosing(
+        _groq_stream(url, headers, payload)
+    ) as stream:
+        async for chunk, reason in stream:
+            if chunk:
+                if not chunks:
+                    deadline.reschedule(None)
+                chunks.append(chunk)
+                on_token(chunk)
+            finish_reason = reason or finish_reason
+    return "".join(chunks), finish_reason == "length"
+
+
+async def _ollama_generate(prompt: str, system_prompt: Optional[str] = None) -> str:
     """
-    Synchronous function to call Ollama via requests, wrapped for async. 
+    Calls Ollama through the shared async HTTP client (keep-alive, no thread hop).
     GUARANTEED to return a string (error message if failed).
     """
     headers = {"Content-Type": "application/json"}
@@ -39,74 +204,139 @@ async def _ollama_generate(prompt: str) -> str:
         "model": OLLAMA_MODEL,
         "prompt": prompt,
         "stream": False,
-        "options": {"temperature": 0.1},
+        "options": {"temperature": 0.1, "stop": [END_SENTINEL]},
     }
+    if system_prompt:
+        payload["system"] = system_prompt
     
     try:
-        # Use requests, run in a thread to avoid blocking the event loop
-        response = await asyncio.to_thread(requests.post, OLLAMA_URL, headers=headers, json=payload, timeout=60)
+        # Local generation is slower than Groq, so it gets a longer per-request timeout
+        response = await _get_http_client().post(
+            OLLAMA_URL, headers=headers, content=orjson.dumps(payload), timeout=60
+        )
         response.raise_for_status()
         
         # Ollama returns a JSON response; extract the content
-        data = response.json()
-        content = data.get("response", "").strip()
+        content = orjson.loads(response.content).get("response", "").strip()
         
         if content:
             return content
         else:
             return "Error: Ollama server returned an empty response."
 
-    except requests.exceptions.RequestException as e:
+    except (httpx.HTTPError, ValueError) as e:
+        # Connection/HTTP failures and undecodable (non-JSON) bodies alike
         error_msg = str(e).splitlines()[0] if str(e) else "Unknown Request Error."
         print(f"Ollama Request Error: {error_msg}")
-        return f"Error: Failed to connect to Ollama server. Details: {error_msg}"
-    except json.JSONDecodeError:
-        print("Ollama Response Error: Could not decode JSON.")
-        return "Error: Ollama server returned an invalid response format (not JSON)."
+        return f"Error: Failed to get a valid response from Ollama server. Details: {error_msg}"
     except Exception as e:
         print(f"General Ollama Error: {e}")
         return f"Error: An unexpected error occurred in Ollama call: {e}"
 
 
-async def call_llm(prompt_to_send: str, is_meta_prompt: bool = True) -> str:
+@semantic_cache
+async def call_llm(
+    prompt_to_send: str,
+    is_meta_prompt: bool = True,
+    max_tokens: Optional[int] = None,
+    on_token: Optional[Callable[[str], None]] = None,
+    system_prompt: Optional[str] = None,
+) -> str:
     """
-    Asynchronously calls the LLM, prioritizing Groq (via requests), otherwise falling back to Ollama.
+    Asynchronously calls the LLM, prioritizing Groq (via httpx), otherwise falling back to Ollama.
+    `system_prompt`, if given, is sent as a separate system message ahead of the prompt.
+    `max_tokens` overrides the per-prompt-type default; a Groq response cut off at the
+    cap is retried once with double the cap. When `on_token` is given the
+    Groq response is streamed and each chunk is passed to it as it arrives (Ollama
+    passes its full response once); the accumulated text is still returned. Before a
+    retry or fallback re-streams a partly streamed answer, `on_token` gets STREAM_RESET.
     GUARANTEED to return a string.
     """
-    # Determine max tokens based on prompt type
-    max_tokens = 500 if is_meta_prompt else 700 
+    # Determine model and max tokens based on prompt type
+    model = GROQ_META_MODEL if is_meta_prompt else GROQ_EXEC_MODEL
+    if max_tokens is None:
+        max_tokens = 250 if is_meta_prompt else 600 
+
+    streaming = on_token is not None
+    streamed = False
+    first_token_at = None
+
+    def forward(chunk: str) -> None:
+        nonlocal streamed, first_token_at
+        if first_token_at is None:
+            first_token_at = time.perf_counter()
+        streamed = True
+        on_token(chunk)
+
+    def reset_stream() -> None:
+        # Clear a partly streamed answer before it is streamed again
+        nonlocal streamed
+        if streamed:
+            on_token(STREAM_RESET)
+            streamed = False
     
     if HIGH_SPEED_MODE:
-        # --- Groq Call (High Speed via requests) ---
+        # --- Groq Call (High Speed via httpx) ---
         url = "https://api.groq.com/openai/v1/chat/completions"
         headers = {
             "Authorization": f"Bearer {GROQ_API_KEY}",
             "Content-Type": "application/json",
         }
+        messages = [{"role": "user", "content": prompt_to_send}]
+        if system_prompt:
+            messages.insert(0, {"role": "system", "content": system_prompt})
         payload = {
-            "model": GROQ_MODEL,
-            "messages": [{"role": "user", "content": prompt_to_send}],
+            "model": model,
+            "messages": messages,
             "temperature": 0.1,
-            "stream": False,
+            "stream": streaming,
             "max_tokens": max_tokens,
+            # Stop decoding as soon as a single-shot response is complete
+            "stop": [END_SENTINEL],
         }
         
-        max_retries = 2
-        for attempt in range(max_retries):
+        truncated_content = None
+        budget = _LATENCY_BUDGETS.setdefault((model, max_tokens, streaming), _LatencyBudget())
+        for attempt in range(GROQ_MAX_RETRIES):
+            reset_stream()
+            # The last attempt may run to the HTTP timeout rather than fall back early
+            limit = budget.seconds() if attempt < GROQ_MAX_RETRIES - 1 else None
+            started = time.perf_counter()
+            first_token_at = None
             try:
-                # Run the synchronous request in a separate thread
-                response = await asyncio.to_thread(requests.post, url, headers=headers, json=payload, timeout=30)
-                response.raise_for_status() # Raises HTTPError for bad responses (4xx or 5xx)
-                
-                data = response.json()
-                # CRITICAL FIX: Direct access to content and validation
-                content = data.get('choices', [{}])[0].get('message', {}).get('content')
+                if streaming:
+                    # The budget only covers time to first token, never a stream in progress
+                    content, truncated = await _groq_attempt(
+                        url, headers, payload, forward, first_token_timeout=limit
+                    )
+                else:
+                    content, truncated = await asyncio.wait_for(
+                        _groq_attempt(url, headers, payload, None), timeout=limit
+                    )
                 
                 # Check for None and return the content safely
                 if content:
+                    finished = first_token_at if streaming else time.perf_counter()
+                    budget.observe(finished - started)
+                    if truncated and truncated_content is None:
+                        # Hit the cap: keep this answer as a fallback and retry once with double
+                        print(f"Groq response hit max_tokens={max_tokens}. Retrying with {max_tokens * 2}...")
+                        truncated_content = content.strip()
+                        payload["max_tokens"] = max_tokens * 2
+                        budget = _LATENCY_BUDGETS.setdefault(
+                            (model, max_tokens * 2, streaming), _LatencyBudget()
+                        )
+                        continue
+                    if truncated:
+                        # The retry at double the cap was cut off too: return it, never cache it
+                        return UncacheableResponse(content.strip())
                     return content.strip()
                 
-            except requests.exceptions.RequestException as e:
+            except asyncio.TimeoutError:
+                # Record the censored sample so the budget can grow if Groq gets slower
+                budget.observe(limit)
+                print(f"Groq attempt {attempt+1} exceeded the {limit:.1f}s latency budget. Retrying...")
+            except httpx.HTTPError as e:
                 print(f"Groq API Error on attempt {attempt+1}: {e}")
             except (KeyError, IndexError) as e:
                 print(f"Groq Response Structure Error on attempt {attempt+1}: {e}")
@@ -114,27 +344,54 @@ async def call_llm(prompt_to_send: str, is_meta_prompt: bool = True) -> str:
                 # Catch general exceptions (e.g., JSONDecodeError)
                 print(f"General Groq Error on attempt {attempt+1}: {e}")
             
-            # Exponential backoff
-            await asyncio.sleep(2 ** attempt)
+            # Short jittered exponential backoff de-synchronizes concurrent retries
+            if attempt < GROQ_MAX_RETRIES - 1:
+                await asyncio.sleep(random.uniform(0.1, 0.3) * (2 ** attempt))
 
-        # If Groq fails after retries, automatically fall back to Ollama
-        print(f"Groq failed after {max_retries} retries. Falling back to Ollama...")
-        return await _ollama_generate(prompt_to_send)
+        if truncated_content is not None:
+            # Return the cut-off answer, but never cache it
+            reset_stream()
+            if on_token is not None:
+                forward(truncated_content)
+            return UncacheableResponse(truncated_content)
 
+        # If Groq fails after retries, automatically fall back to Ollama
+        print(f"Groq failed after {GROQ_MAX_RETRIES} retries. Falling back to Ollama...")
     else:
         # --- Ollama Call (Local Fallback) ---
         print("Using Ollama (Local Fallback)...")
-        return await _ollama_generate(prompt_to_send)
+
+    reset_stream()
+    content = await _ollama_generate(prompt_to_send, system_prompt)
+    if on_token is not None and not content.startswith("Error:"):
+        on_token(content)
+    return content
 
 
 # --- Prompt Construction and Parsing ---
 
-def build_meta_instruction(task_description: str, target_code: str) -> str:
-    """
-    Constructs the detailed system instruction for the Universal Optimization Agent.
-    """
-    meta_instruction = f"""
-You are a Universal Optimization Agent.
+# Delimiters for single-shot responses that carry both the prompt and its result
+PROMPT_SENTINEL = "<<<PROMPT>>>"
+OUTPUT_SENTINEL = "<<<OUTPUT>>>"
+END_SENTINEL = "<<<END>>>"
+
+_PROMPT_ONLY_FORMAT = (
+    "All output must be the *optimized prompt only*—no meta, no explanations, "
+    "just the thing to send to the next assistant, which is concise and precise."
+)
+
+_SINGLE_SHOT_FORMAT = f"""The optimized prompt itself must be concise and precise—no meta, no explanations.
+Then, apply the optimized prompt yourself and emit exactly:
+{PROMPT_SENTINEL}
+(the optimized prompt)
+{OUTPUT_SENTINEL}
+(your response to the optimized prompt)
+{END_SENTINEL}"""
+
+
+# Static instruction body, built once and sent as the system message so
+# identical prefixes can reuse Groq's prefill cache across requests.
+_META_BODY = """You are a Universal Optimization Agent.
 Rewrite the user's request so any AI assistant delivers a result that is simple, clear, and maximally user-friendly.
 
 - For any code-related tasks, your optimized prompt MUST require:
@@ -154,11 +411,18 @@ Rewrite the user's request so any AI assistant delivers a result that is simple,
 - If code or technical output is specifically warranted or obviously the best fit, provide it as described above.
 - If the prompt is open-ended, general, or only about advice, respond only in human language—clear, actionable statements, not code or technical logic—unless the user’s intent or context changes.
 - Use professional judgement, not keyword triggers, to ensure the answer feels natural and goal-oriented for the specific user and their likely scenario.
-- If unsure, briefly clarify or offer a menu of helpful next actions instead of assuming their intent.
+- If unsure, briefly clarify or offer a menu of helpful next actions instead of assuming their intent."""
+
+# System prompt for the optimizer step (optimized prompt only)
+META_PREFIX = f"{_META_BODY}\n\n{_PROMPT_ONLY_FORMAT}"
+# System prompt for single-shot mode (optimized prompt and its result between sentinels)
+SINGLE_SHOT_META_PREFIX = f"{_META_BODY}\n\n{_SINGLE_SHOT_FORMAT}"
 
-All output must be the *optimized prompt only*—no meta, no explanations, just the thing to send to the next assistant, which is concise and precise.
 
-TASK: {task_description}
-CONTEXT: {target_code}
-"""
-    return meta_instruction.strip()
+def build_meta_instruction(task_description: str, target_code: str) -> str:
+    """
+    Constructs the per-request user message for the Universal Optimization Agent.
+    The detailed instruction itself is META_PREFIX (or SINGLE_SHOT_META_PREFIX),
+    sent as the system message.
+    """
+    return f"TASK: {task_description}\nCONTEXT: {target_code}"